@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+"""
+比较原有字典文件树与 CompactTree 的内存占用。
+
+分别测量以下结构构建完成后的常驻内存和构建过程中的峰值内存：
+- kb_tree: get_KB_FILE_URL.py 中的知识库文件树 {路径: {"modifiedTime": ..., "url": ...}}
+- nas_tree: get_KB_FILE_URL.py 中的NAS文件树 {路径: {"modifiedTime": ..., "path": ...}}
+- 加载 kb_tree.json: compare_move_file.py 读取 kb_tree.json 的完整过程。原实现为 json.load 加规范化路径集合，
+  现在为 CompactTree.load_json 流式读取。
+
+前两项的URL字符串由两种结构共享引用，不计入测量结果；第三项从真实文件读取，计入全部内存。
+
+用法:
+    python benchmark_tree_memory.py [文件数量，默认200000]
+"""
+import gc
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import tracemalloc
+
+from kb_tree_model import CompactTree
+
+NAS_ROOT = "/mnt/nas/知识库同步"
+
+
+def generate_entries(count, files_per_folder=20, seed=0):
+    """
+    生成模拟的知识库文件列表：(各级名称, 修改时间戳, URL)。
+
+    目录按层级展开（每个目录约10个子目录），每个末级目录约有 files_per_folder 个文件。
+    路径和时间字符串在 build_* 中重新构造，使两种结构都计入各自持有的字符串。
+    """
+    rng = random.Random(seed)
+    entries = []
+    for i in range(count):
+        folder = i // files_per_folder
+        parts = [f"文档_{i}.docx"]
+        while True:
+            parts.append(f"目录{folder % 10}")
+            folder //= 10
+            if not folder:
+                break
+        parts.append(f"部门{i // files_per_folder % 20}")
+        parts.reverse()
+        timestamp = 1704067200 + rng.randint(0, 365 * 86400)
+        url = f"https://alidocs.dingtalk.com/i/nodes/{i:032x}"
+        entries.append((tuple(parts), timestamp, url))
+    return entries
+
+
+def format_time(timestamp):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(timestamp))
+
+
+def measure(build):
+    """返回 build() 生成的对象的常驻内存和构建过程中的峰值内存（字节）。"""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    gc.collect()
+    return size, peak
+
+
+def build_kb_dict(entries):
+    return {"/".join(parts): {"modifiedTime": format_time(ts), "url": url} for parts, ts, url in entries}
+
+
+def build_nas_dict(entries):
+    return {"/".join(parts): {"modifiedTime": format_time(ts), "path": os.path.join(NAS_ROOT, *parts)}
+            for parts, ts, _ in entries}
+
+
+def build_normalized_set(entries):
+    return {os.path.normpath("/".join(parts)) for parts, _, _ in entries}
+
+
+def build_kb_compact(entries):
+    tree = CompactTree()
+    for parts, ts, url in entries:
+        tree["/".join(parts)] = {"modifiedTime": format_time(ts), "url": url}
+    return tree
+
+
+def build_nas_compact(entries):
+    tree = CompactTree(root_path=NAS_ROOT, with_urls=False)
+    for parts, ts, _ in entries:
+        tree.add("/".join(parts), float(ts))
+    return tree
+
+
+def load_kb_json_dict(kb_tree_file):
+    """原 compare_move_file.py 的加载方式。"""
+    with open(kb_tree_file, 'r', encoding='utf-8') as f:
+        kb_tree = json.load(f)
+    return kb_tree, {os.path.normpath(p) for p in kb_tree.keys()}
+
+
+def load_kb_json_compact(kb_tree_file):
+    with open(kb_tree_file, 'r', encoding='utf-8') as f:
+        return CompactTree.load_json(f)
+
+
+def main(count):
+    print(f"生成 {count} 个模拟文件...")
+    entries = generate_entries(count)
+
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', suffix='.json', delete=False) as f:
+        json.dump(build_kb_dict(entries), f, ensure_ascii=False, indent=4)
+        kb_tree_file = f.name
+
+    # 每一行对应一个脚本运行时同时持有的结构
+    rows = [
+        ("kb_tree", lambda: build_kb_dict(entries), lambda: build_kb_compact(entries)),
+        ("nas_tree", lambda: build_nas_dict(entries), lambda: build_nas_compact(entries)),
+        ("加载 kb_tree.json", lambda: load_kb_json_dict(kb_tree_file), lambda: load_kb_json_compact(kb_tree_file)),
+    ]
+    try:
+        print(f"\n{'结构':<24}{'字典 常驻/峰值 (MB)':>22}{'CompactTree 常驻/峰值 (MB)':>30}")
+        for name, build_dict, build_compact in rows:
+            dict_size, dict_peak = measure(build_dict)
+            compact_size, compact_peak = measure(build_compact)
+            print(f"{name:<24}{dict_size / 2**20:>13.1f} / {dict_peak / 2**20:<7.1f}"
+                  f"{compact_size / 2**20:>20.1f} / {compact_peak / 2**20:<7.1f}")
+    finally:
+        os.remove(kb_tree_file)
+
+    # 查找速度对比
+    kb_dict = build_kb_dict(entries)
+    kb_tree = build_kb_compact(entries)
+    paths = ["/".join(parts) for parts, _, _ in entries]
+    for label, tree in (("字典", kb_dict), ("CompactTree", kb_tree)):
+        start_time = time.perf_counter()
+        for path in paths:
+            path in tree
+        print(f"{label} 查找 {count} 次耗时: {time.perf_counter() - start_time:.2f} 秒")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -2,7 +2,369 @@ import os
 import json
 import shutil
 
-def sync_nas_with_kb_tree(kb_tree_file, source_folder, destination_folder, dry_run=False):
+from kb_tree_model import CompactTree
+
+# 事务模式下使用的计划文件和预写日志文件名，默认放在 kb_tree.json 所在目录（应在目标文件夹之外，避免被清理阶段删除）
+SYNC_PLAN_FILE = 'sync_plan.json'
+SYNC_JOURNAL_FILE = 'sync_journal.log'
+# 原子发布时使用的临时文件后缀
+TEMP_SUFFIX = '.synctmp'
+# 事务模式下单个操作最多重试的运行次数，超过后放弃该操作，避免一个操作永久阻塞后续同步
+MAX_OPERATION_RETRIES = 3
+
+
+def build_sync_plan(normalized_kb_paths, source_folder, destination_folder):
+    """
+    扫描目标文件夹和源文件夹，生成同步计划（删除和移动操作的有序列表）。
+
+    计划中的路径均为相对路径，删除操作按从下到上的顺序排列，保证子项先于父目录被删除。
+
+    :param normalized_kb_paths: 由知识库文件树构建的 CompactTree，路径查找会自动规范化分隔符。
+    :param source_folder: 包含新下载文件的源文件夹。
+    :param destination_folder: NAS目标文件夹。
+    :return: 操作列表，每个操作形如 {"op": "delete_file" | "delete_dir" | "move", "path": 相对路径}。
+    """
+    operations = []
+
+    if os.path.isdir(destination_folder):
+        # 记录清理后仍会保留内容的目录，用于模拟“删除文件后目录变空”的情况
+        non_empty_dirs = set()
+        for root, dirs, files in os.walk(destination_folder, topdown=False):
+            root_relative = os.path.normpath(os.path.relpath(root, destination_folder))
+            for name in files:
+                relative_path = os.path.normpath(os.path.join(root_relative, name))
+                if relative_path not in normalized_kb_paths:
+                    operations.append({"op": "delete_file", "path": relative_path})
+                else:
+                    non_empty_dirs.add(root_relative)
+
+            for name in dirs:
+                relative_path = os.path.normpath(os.path.join(root_relative, name))
+                if relative_path in non_empty_dirs:
+                    non_empty_dirs.add(root_relative)
+                    continue
+                if normalized_kb_paths.has_dir(relative_path):
+                    non_empty_dirs.add(root_relative)
+                else:
+                    operations.append({"op": "delete_dir", "path": relative_path})
+
+    if os.path.isdir(source_folder):
+        for root, _, files in os.walk(source_folder):
+            for name in files:
+                relative_path = os.path.relpath(os.path.join(root, name), source_folder)
+                operations.append({"op": "move", "path": relative_path})
+
+    return operations
+
+
+def write_sync_plan(plan_file, plan):
+    """
+    通过“临时文件 + 重命名”的方式原子地写入计划文件，避免留下写了一半的计划。
+    """
+    temp_path = plan_file + TEMP_SUFFIX
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(plan, f, ensure_ascii=False, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, plan_file)
+
+
+def load_journal(journal_file):
+    """
+    读取预写日志，返回 (已完成的操作序号集合, {操作序号: 失败次数})。
+
+    日志每行为 "DONE <序号>" 或 "FAILED <序号>"。只接受以换行符结尾的完整行，
+    崩溃时写了一半的最后一行（例如把 "DONE 12" 截断成 "DONE 1"）会被忽略。
+    没有 DONE 记录的操作都会被重新执行，所有操作都是幂等的，因此不需要额外记录操作的开始。
+    """
+    finished, failures = set(), {}
+    if not os.path.exists(journal_file):
+        return finished, failures
+    with open(journal_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.endswith("\n"):
+                continue
+            parts = line.split()
+            if len(parts) != 2 or not parts[1].isdigit():
+                continue
+            index = int(parts[1])
+            if parts[0] == 'DONE':
+                finished.add(index)
+            elif parts[0] == 'FAILED':
+                failures[index] = failures.get(index, 0) + 1
+    return finished, failures
+
+
+def _append_journal(journal, record):
+    """向预写日志追加一条记录并立即落盘。"""
+    journal.write(record + "\n")
+    journal.flush()
+    os.fsync(journal.fileno())
+
+
+def _fsync_file(path):
+    """将文件内容刷到磁盘。"""
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+
+
+def _fsync_dir(path):
+    """将目录项（重命名、删除）刷到磁盘。Windows 不支持对目录 fsync，此时直接跳过。"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _publish_file(source_path, destination_path):
+    """
+    将源文件原子地发布到目标位置，任何时刻断电都不会留下不完整的目标文件或丢失源文件。
+
+    - 同一文件系统: fsync 源文件 -> os.replace 到目标位置 -> fsync 目标目录。
+    - 跨文件系统（例如下载目录在本地、目标在NAS）: 复制到临时文件 -> fsync 临时文件 ->
+      os.replace 到目标位置 -> fsync 目标目录 -> 删除源文件。
+    源文件只在目标文件已经落盘后才会删除，因此中断后重放该操作总能得到完整的结果。
+    """
+    destination_dir = os.path.dirname(destination_path) or '.'
+    os.makedirs(destination_dir, exist_ok=True)
+    _fsync_file(source_path)
+    if os.stat(source_path).st_dev == os.stat(destination_dir).st_dev:
+        os.replace(source_path, destination_path)
+        _fsync_dir(destination_dir)
+        _fsync_dir(os.path.dirname(source_path) or '.')
+        return
+
+    temp_path = destination_path + TEMP_SUFFIX
+    shutil.copy2(source_path, temp_path)
+    _fsync_file(temp_path)
+    os.replace(temp_path, destination_path)
+    _fsync_dir(destination_dir)
+    os.remove(source_path)
+
+
+def apply_sync_operation(operation, source_folder, destination_folder):
+    """
+    幂等地执行单个同步操作。重复执行同一个操作不会产生副作用，因此崩溃后可以安全重放。
+
+    移动操作通过 _publish_file 原子地发布，NAS上的文件要么是旧版本，要么是完整的新版本。
+    """
+    relative_path = operation["path"]
+    if operation["op"] == "delete_file":
+        file_path = os.path.join(destination_folder, relative_path)
+        if os.path.lexists(file_path):
+            os.remove(file_path)
+    elif operation["op"] == "delete_dir":
+        dir_path = os.path.join(destination_folder, relative_path)
+        if os.path.isdir(dir_path) and not os.listdir(dir_path):
+            os.rmdir(dir_path)
+    elif operation["op"] == "move":
+        source_path = os.path.join(source_folder, relative_path)
+        destination_path = os.path.join(destination_folder, relative_path)
+        temp_path = destination_path + TEMP_SUFFIX
+        if os.path.exists(source_path):
+            # 上次中断可能留下不完整的临时文件，源文件仍在时直接丢弃重来
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            _publish_file(source_path, destination_path)
+        elif os.path.exists(temp_path):
+            # 源文件已删除说明目标文件早已发布，残留的临时文件没有用处
+            os.remove(temp_path)
+    else:
+        raise ValueError(f"未知的同步操作: {operation['op']}")
+
+
+def run_sync_plan(plan, plan_file, journal_file):
+    """
+    按预写日志执行同步计划，跳过日志中已完成的操作。
+
+    失败的操作会以 "FAILED <序号>" 记入日志，并在之后的运行中重试；同一操作累计失败
+    MAX_OPERATION_RETRIES 次后放弃，不再阻塞计划。没有待重试的操作时，计划文件和日志会被删除，
+    下次运行将重新扫描并生成新计划。
+
+    :return: (是否所有操作都已成功完成, 被放弃的操作列表)。
+    """
+    source_folder = plan["source_folder"]
+    destination_folder = plan["destination_folder"]
+    operations = plan["operations"]
+    finished, failures = load_journal(journal_file)
+    if finished or failures:
+        print(f"从日志恢复: {len(finished)}/{len(operations)} 个操作已完成，"
+              f"{len(failures)} 个操作曾经失败，其余未完成的操作将重新执行。")
+
+    labels = {"delete_file": "删除文件", "delete_dir": "删除空目录", "move": "移动文件"}
+    pending, abandoned = [], []
+    with open(journal_file, 'a', encoding='utf-8') as journal:
+        for index, operation in enumerate(operations):
+            if index in finished:
+                continue
+            if failures.get(index, 0) >= MAX_OPERATION_RETRIES:
+                abandoned.append(operation)
+                continue
+            print(f"[{labels.get(operation['op'], operation['op'])}] {operation['path']}")
+            try:
+                apply_sync_operation(operation, source_folder, destination_folder)
+            except (OSError, shutil.Error) as e:
+                print(f"  错误: 操作失败: {e}")
+                _append_journal(journal, f"FAILED {index}")
+                if failures.get(index, 0) + 1 >= MAX_OPERATION_RETRIES:
+                    abandoned.append(operation)
+                else:
+                    pending.append(operation)
+                continue
+            _append_journal(journal, f"DONE {index}")
+
+    if abandoned:
+        print(f"警告: 以下 {len(abandoned)} 个操作已失败 {MAX_OPERATION_RETRIES} 次，已放弃，请手动检查:")
+        for operation in abandoned:
+            print(f"  {operation['op']} {operation['path']}")
+    if pending:
+        print(f"有 {len(pending)} 个操作失败，保留计划文件 '{plan_file}' 和日志 '{journal_file}'，下次运行时将重试。")
+        return False, abandoned
+
+    # 先删除计划文件再删除日志：若在两者之间中断，孤立的日志会在下次运行时被忽略
+    os.remove(plan_file)
+    os.remove(journal_file)
+    return not abandoned, abandoned
+
+
+def _kb_tree_mtime(kb_tree_file):
+    """返回 kb_tree.json 的修改时间，文件不存在时返回 None。"""
+    try:
+        return os.path.getmtime(kb_tree_file)
+    except OSError:
+        return None
+
+
+def _replay_sync_plan(kb_tree_file, source_folder, destination_folder, dry_run, plan_file, journal_file):
+    """
+    重放上次中断的同步计划中未完成的操作。
+
+    计划只有在基于当前的 kb_tree.json（路径和修改时间都一致）生成时才会被重放；
+    否则计划中的删除操作可能已经过时，此时丢弃旧计划，由调用方根据新的知识库文件树重新生成。
+    所有操作都是幂等的，丢弃旧计划不会留下不一致的状态：未移动完的源文件仍在源文件夹中，
+    残留的临时文件不在知识库文件树中，都会被新计划处理。
+
+    :return: (是否可以继续生成新计划, 重放是否没有放弃任何操作)。
+    """
+    try:
+        with open(plan_file, 'r', encoding='utf-8') as f:
+            plan = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"错误: 读取未完成的同步计划 '{plan_file}' 失败: {e}。请检查后手动删除。")
+        return False, False
+    if (plan.get("source_folder") != source_folder
+            or plan.get("destination_folder") != destination_folder):
+        print(f"错误: 未完成的同步计划 '{plan_file}' 属于其他源/目标文件夹 "
+              f"({plan.get('source_folder')} -> {plan.get('destination_folder')})，无法继续。")
+        return False, False
+    if (plan.get("kb_tree_file") != kb_tree_file
+            or plan.get("kb_tree_mtime") != _kb_tree_mtime(kb_tree_file)):
+        print(f"警告: 未完成的同步计划 '{plan_file}' 基于其他或较旧的知识库文件树 "
+              f"'{plan.get('kb_tree_file')}' 生成，已丢弃，将根据当前的知识库文件树重新生成计划。")
+        if not dry_run:
+            os.remove(plan_file)
+        return True, True
+
+    print(f"发现未完成的同步计划 '{plan_file}'，先重放未完成的操作。")
+    if dry_run:
+        finished, _ = load_journal(journal_file)
+        for index, operation in enumerate(plan["operations"]):
+            if index not in finished:
+                print(f"[待重放] {operation['op']} {operation['path']}")
+        return True, True
+    succeeded, abandoned = run_sync_plan(plan, plan_file, journal_file)
+    if os.path.exists(plan_file):
+        # 仍有待重试的操作，先不生成新计划，避免两个计划交错执行
+        return False, False
+    print("旧计划重放完成。")
+    return True, not abandoned
+
+
+def sync_nas_with_kb_tree_transactional(kb_tree_file, source_folder, destination_folder, dry_run=False,
+                                        plan_file=None, journal_file=None):
+    """
+    事务模式的同步：先生成计划文件，再按预写日志逐个执行操作。
+
+    若上次同步中途崩溃，计划文件仍然存在，此时先重放计划中未完成的部分，再照常扫描目录、
+    生成并执行新计划，使本次运行期间新下载的文件也能被同步。
+
+    :param kb_tree_file: kb_tree.json文件的路径。
+    :param source_folder: 包含新下载和整理好的文件的源文件夹。
+    :param destination_folder: 最终要同步的NAS目标文件夹。
+    :param dry_run: 是否为演练模式。True时只打印计划，不写入计划文件也不执行。
+    :param plan_file: 计划文件路径，默认为 kb_tree.json 所在目录下的 SYNC_PLAN_FILE。
+    :param journal_file: 预写日志文件路径，默认为 kb_tree.json 所在目录下的 SYNC_JOURNAL_FILE。
+    :return: 本次同步的所有操作是否都已成功完成。有操作失败或被放弃时返回 False。
+    """
+    # 统一使用绝对路径，使计划文件与当前工作目录无关
+    kb_tree_file = os.path.abspath(kb_tree_file)
+    source_folder = os.path.abspath(source_folder)
+    destination_folder = os.path.abspath(destination_folder)
+    kb_tree_dir = os.path.dirname(kb_tree_file)
+    plan_file = plan_file or os.path.join(kb_tree_dir, SYNC_PLAN_FILE)
+    journal_file = journal_file or os.path.join(kb_tree_dir, SYNC_JOURNAL_FILE)
+
+    # 1. 检查是否存在未完成的计划
+    replay_succeeded = True
+    if os.path.exists(plan_file):
+        can_continue, replay_succeeded = _replay_sync_plan(kb_tree_file, source_folder, destination_folder,
+                                                           dry_run, plan_file, journal_file)
+        if not can_continue:
+            return False
+
+    # 计划文件不存在时残留的日志属于已完成或已丢弃的旧计划，直接丢弃
+    if os.path.exists(journal_file) and not dry_run:
+        os.remove(journal_file)
+
+    # 2. 加载知识库文件树并生成计划
+    kb_tree_mtime = _kb_tree_mtime(kb_tree_file)
+    try:
+        # 流式读取为紧凑文件树，避免先用 json.load 构造完整的字典
+        with open(kb_tree_file, 'r', encoding='utf-8') as f:
+            normalized_kb_paths = CompactTree.load_json(f)
+        print("成功加载知识库文件树。")
+    except FileNotFoundError:
+        print(f"错误: 知识库文件树 '{kb_tree_file}' 未找到。无法继续。")
+        return False
+    except json.JSONDecodeError:
+        print(f"错误: 解析知识库文件树 '{kb_tree_file}' 失败。")
+        return False
+
+    plan = {
+        "kb_tree_file": kb_tree_file,
+        "kb_tree_mtime": kb_tree_mtime,
+        "source_folder": source_folder,
+        "destination_folder": destination_folder,
+        "operations": build_sync_plan(normalized_kb_paths, source_folder, destination_folder),
+    }
+    print(f"同步计划已生成，共 {len(plan['operations'])} 个操作。")
+
+    if dry_run:
+        for operation in plan["operations"]:
+            print(f"[计划] {operation['op']} {operation['path']}")
+        print("\n--- 同步完成 ---")
+        return True
+
+    # 3. 写入计划文件后再执行，之后任何时刻崩溃都可以从计划和日志恢复
+    try:
+        write_sync_plan(plan_file, plan)
+    except OSError as e:
+        print(f"错误: 无法写入同步计划 '{plan_file}': {e}")
+        return False
+    succeeded, _ = run_sync_plan(plan, plan_file, journal_file)
+    if succeeded:
+        print("\n--- 同步完成 ---")
+    return succeeded and replay_succeeded
+
+
+def sync_nas_with_kb_tree(kb_tree_file, source_folder, destination_folder, dry_run=False, transactional=False,
+                          plan_file=None, journal_file=None):
     """
     使用知识库文件树（kb_tree.json）作为权威来源，同步NAS文件夹。
 
@@ -13,6 +375,10 @@ def sync_nas_with_kb_tree(kb_tree_file, source_folder, destination_folder, dry_r
     :param source_folder: 包含新下载和整理好的文件的源文件夹。
     :param destination_folder: 最终要同步的NAS目标文件夹。
     :param dry_run: 是否为演练模式。True时只打印操作，不实际执行。
+    :param transactional: 是否使用事务模式。True时先生成计划文件并通过预写日志执行，崩溃后可恢复，
+                          并返回所有操作是否都已成功完成。
+    :param plan_file: 事务模式的计划文件路径，默认为 kb_tree.json 所在目录下的 SYNC_PLAN_FILE。
+    :param journal_file: 事务模式的预写日志文件路径，默认为 kb_tree.json 所在目录下的 SYNC_JOURNAL_FILE。
     """
     print("--- 开始同步 ---")
     print(f"知识库树: {kb_tree_file}")
@@ -22,10 +388,15 @@ def sync_nas_with_kb_tree(kb_tree_file, source_folder, destination_folder, dry_r
     print(f"模式: {mode}")
     print("-" * 20)
 
+    if transactional:
+        return sync_nas_with_kb_tree_transactional(kb_tree_file, source_folder, destination_folder, dry_run,
+                                                   plan_file, journal_file)
+
     # 1. 加载知识库文件树
     try:
+        # 流式读取为紧凑文件树，避免先用 json.load 构造完整的字典
         with open(kb_tree_file, 'r', encoding='utf-8') as f:
-            kb_tree = json.load(f)
+            normalized_kb_paths = CompactTree.load_json(f)
         print("成功加载知识库文件树。")
     except FileNotFoundError:
         print(f"错误: 知识库文件树 '{kb_tree_file}' 未找到。无法继续。")
@@ -34,9 +405,7 @@ def sync_nas_with_kb_tree(kb_tree_file, source_folder, destination_folder, dry_r
         print(f"错误: 解析知识库文件树 '{kb_tree_file}' 失败。")
         return
 
-    # 规范化kb_tree的键，以匹配本地文件系统
-    # 将所有路径分隔符统一为os.sep
-    normalized_kb_paths = {os.path.normpath(p) for p in kb_tree.keys()}
+    # 紧凑文件树在查找时会自动规范化路径分隔符，以匹配本地文件系统
 
     # --- 2. 清理阶段 ---
     print("\n--- 阶段 1: 清理目标文件夹 ---")
@@ -62,11 +431,11 @@ def sync_nas_with_kb_tree(kb_tree_file, source_folder, destination_folder, dry_r
                 dir_path = os.path.join(root, name)
                 # 检查目录是否为空
                 if not os.listdir(dir_path):
-                    # 检查该目录本身是否应该存在（通过检查是否有任何kb路径以它开头）
+                    # 检查该目录本身是否应该存在（通过检查它是否为知识库中某个文件的上级目录）
                     relative_path = os.path.normpath(os.path.relpath(dir_path, destination_folder))
                     
-                    # 如果没有任何知识库文件路径以这个目录作为前缀，那么它就是多余的
-                    is_needed_dir = any(p.startswith(relative_path + os.sep) for p in normalized_kb_paths)
+                    # 如果知识库文件树中不存在这个目录，那么它就是多余的
+                    is_needed_dir = normalized_kb_paths.has_dir(relative_path)
                     
                     if not is_needed_dir:
                         print(f"[删除空目录] {relative_path}")
@@ -16,9 +16,11 @@
 """
 import os
 import json
-import datetime
+import math
 from typing import List, Dict, Any
 
+from kb_tree_model import CompactTree, format_iso_time
+
 # 导入钉钉开放平台Wiki相关的SDK客户端和模型
 from alibabacloud_dingtalk.wiki_2_0.client import Client as dingtalkwiki_2_0Client
 from alibabacloud_dingtalk.wiki_2_0 import models as dingtalkwiki__2__0_models
@@ -35,6 +37,10 @@ OUTPUT_FILE = ""                                          # 定义输出文件
 WORKSPACE_LIST_OUTPUT_FILE = ""                           # 存储获取的知识库列表的文件
 KB_TREE_OUTPUT_FILE = ""                                  # 存储知识库完整文件树的JSON文件
 NAS_ROOT_PATH = ""                                        # 要对比的本地NAS文件夹根路径
+KB_NODE_CACHE_FILE = ""                                   # 存储知识库节点元数据缓存的JSON文件，留空则不使用校验模式
+GET_NODES_BATCH_SIZE = 30                                 # 批量获取节点元数据时每次请求的节点数量
+FULL_RESCAN_INTERVAL = 10                                 # 连续校验多少次后强制完整遍历一次，用于持续检验校验模式依赖的假设
+FOLDER_TIME_CONFIRMATIONS = 3                             # 完整遍历确认多少次“文件变化会更新父文件夹修改时间”后才启用校验模式
 # WORKSPACE_NAME = "知识库导入NAS测试库"                    # 需要遍历的目标知识库的完整名称
 # OUTPUT_FILE = ".\url.json"                              # 定义输出文件的名称，用于存储所有文档的URL
 # WORKSPACE_LIST_OUTPUT_FILE = ".\workspaces_list.json"   # 存储获取的知识库列表的文件
@@ -116,7 +122,7 @@ def create_client() -> dingtalkwiki_2_0Client:
     config.region_id = 'central'
     return dingtalkwiki_2_0Client(config)
 
-def get_node_list(node_id: str, access_token: str, operator_id: str) -> List:
+def get_node_list(node_id: str, access_token: str, operator_id: str, none_on_error: bool = False) -> List:
     """
     调用钉钉API，获取指定节点下的子节点列表。
 
@@ -124,9 +130,11 @@ def get_node_list(node_id: str, access_token: str, operator_id: str) -> List:
         node_id (str): 父节点的ID。
         access_token (str): API访问令牌。
         operator_id (str): 操作人的unionId。
+        none_on_error (bool): 为 True 时，请求失败返回 None 而不是已获取的部分列表。
 
     Returns:
-        List: 包含子节点对象的列表。如果发生错误或没有子节点，则返回空列表。
+        List: 包含子节点对象的列表。如果没有子节点则返回空列表；发生错误时返回已获取的部分列表，
+        none_on_error 为 True 时返回 None。
     """
     client = create_client()
     list_nodes_headers = dingtalkwiki__2__0_models.ListNodesHeaders()
@@ -153,11 +161,87 @@ def get_node_list(node_id: str, access_token: str, operator_id: str) -> List:
         except Exception as err:
             if not UtilClient.empty(err.code) and not UtilClient.empty(err.message):
                 print(f"API请求失败: {err.message}")
+            if none_on_error:
+                return None
             break
             
     return all_nodes
 
-def traverse_kb_nodes(node_id: str, access_token: str, operator_id: str, parent_path: str, file_tree: dict):
+def get_nodes_metadata(node_ids: List[str], access_token: str, operator_id: str):
+    """
+    调用钉钉批量获取节点接口，按批次获取一组节点的最新元数据。
+
+    Args:
+        node_ids (List[str]): 需要查询的节点ID列表。
+        access_token (str): API访问令牌。
+        operator_id (str): 操作人的unionId。
+
+    Returns:
+        Dict[str, Any]: 节点ID到节点对象的映射，已删除或无权限的节点不会出现在结果中。
+        任意一个批次请求失败（限流、网络错误等）时返回 None，避免把失败批次中的节点误判为已删除。
+    """
+    client = create_client()
+    get_nodes_headers = dingtalkwiki__2__0_models.GetNodesHeaders()
+    get_nodes_headers.x_acs_dingtalk_access_token = access_token
+    option = dingtalkwiki__2__0_models.GetNodesRequestOption(
+        with_permission_role=False,
+        with_statistical_info=False
+    )
+
+    nodes_by_id = {}
+    for start in range(0, len(node_ids), GET_NODES_BATCH_SIZE):
+        get_nodes_request = dingtalkwiki__2__0_models.GetNodesRequest(
+            node_ids=node_ids[start:start + GET_NODES_BATCH_SIZE],
+            option=option,
+            operator_id=operator_id
+        )
+        try:
+            response = client.get_nodes_with_options(get_nodes_request, get_nodes_headers, util_models.RuntimeOptions())
+            if response.body and response.body.nodes:
+                for node in response.body.nodes:
+                    nodes_by_id[node.node_id] = node
+        except Exception as err:
+            print(f"API请求失败: {getattr(err, 'message', err)}")
+            return None
+
+    return nodes_by_id
+
+def add_kb_file(file_tree, current_path: str, modified_time, url):
+    """
+    将一个文件加入文件树，并把钉钉专有后缀转换为标准Office后缀。
+    """
+    name, ext = os.path.splitext(current_path)
+    if ext in EXTENSION_MAPPING:
+        new_ext = EXTENSION_MAPPING[ext]
+        final_path = name + new_ext
+        print(f"    后缀名转换: '{ext}' -> '{new_ext}'")
+    else:
+        final_path = current_path
+
+    # 文件与文件夹路径冲突时（如文件夹 '报告.docx' 与文档 '报告.adoc'）记录警告并跳过，不中断遍历
+    file_tree.try_add(final_path, {
+        "modifiedTime": modified_time,
+        "url": url
+    })
+
+def kb_child_path(parent_path: str, name: str) -> str:
+    """拼接子节点的路径，并替换名称中可能存在的无效字符。"""
+    safe_node_name = name.replace('/', '_').replace('\\', '_')
+    return f"{parent_path}/{safe_node_name}" if parent_path else safe_node_name
+
+def folder_cache_entry(parent_node_id: str, node) -> list:
+    """
+    将API返回的文件夹节点转换为节点缓存中的条目 [父节点ID, 名称, 修改时间, hasChildren]。
+
+    缓存只记录文件夹，并使用列表而不是字典保存，文件的元数据由上一次的 kb_tree.json 提供。
+    """
+    return [parent_node_id, node.name, node.modified_time, node.has_children]
+
+# 文件夹缓存条目中各字段的位置
+FOLDER_PARENT, FOLDER_NAME, FOLDER_MTIME, FOLDER_HAS_CHILDREN = range(4)
+
+def traverse_kb_nodes(node_id: str, access_token: str, operator_id: str, parent_path: str, file_tree,
+                      folder_cache: dict = None):
     """
     递归地遍历所有知识库节点，构建文件树。
 
@@ -166,40 +250,325 @@ def traverse_kb_nodes(node_id: str, access_token: str, operator_id: str, parent_
         access_token (str): API访问令牌。
         operator_id (str): 操作人的unionId。
         parent_path (str): 父节点的路径。
-        file_tree (dict): 用于存储文件树的字典。
+        file_tree (CompactTree): 用于存储文件树的紧凑文件树。
+        folder_cache (dict): 可选，用于记录文件夹元数据的缓存字典。
+
+    Returns:
+        bool: 所有文件夹是否都成功列出。有失败时文件树不完整，不能写入 kb_tree.json，
+        否则 compare_move_file.py 会把缺失子树中的文件从NAS中删除。
+    """
+    nodes = get_node_list(node_id, access_token, operator_id, none_on_error=True)
+    if nodes is None:
+        return False
+    complete = True
+    for node in nodes:
+        current_path = kb_child_path(parent_path, node.name)
+        print(f"  正在处理知识库节点: {current_path} (类型: {node.type})")
+
+        if node.type == "FOLDER":
+            if folder_cache is not None:
+                folder_cache[node.node_id] = folder_cache_entry(node_id, node)
+            if not traverse_kb_nodes(node.node_id, access_token, operator_id, current_path, file_tree, folder_cache):
+                complete = False
+        elif node.type == "FILE":
+            add_kb_file(file_tree, current_path, node.modified_time, node.url)
+    return complete
+
+def folder_paths(folders: dict, root_node_id: str) -> dict:
+    """
+    根据文件夹缓存计算每个文件夹在文件树中的路径（根节点为空字符串）。
+    父节点链不完整的文件夹不会出现在结果中。
+    """
+    paths = {root_node_id: ""}
+    for folder_id in folders:
+        chain = []
+        current = folder_id
+        while current not in paths and current in folders:
+            chain.append(current)
+            current = folders[current][FOLDER_PARENT]
+        if current not in paths:
+            continue
+        for child_id in reversed(chain):
+            paths[child_id] = kb_child_path(paths[current], folders[child_id][FOLDER_NAME])
+            current = child_id
+    return paths
+
+def collect_folder_time_evidence(old_kb_tree, new_kb_tree, old_folders: dict, new_folders: dict,
+                                 root_node_id: str):
+    """
+    对比两次完整遍历的结果，检验“文件新增、删除、改名或更新时，父文件夹的修改时间会变化”这一假设。
+
+    钉钉文档没有说明文件夹修改时间的更新规则，校验模式却依赖这一点，因此不做假设，而是在每次完整遍历时
+    用真实API返回的数据检验：对每个有文件变化的文件夹（两次都存在且路径未变），若其修改时间也变化了，
+    则与假设一致；若没有变化，则假设不成立。
+
+    Returns:
+        tuple: (与假设一致的文件夹数, 与假设矛盾的文件夹数)。
+    """
+    old_times = {path: old_folders[folder_id][FOLDER_MTIME]
+                 for folder_id, path in folder_paths(old_folders, root_node_id).items()}
+    new_times = {path: new_folders[folder_id][FOLDER_MTIME]
+                 for folder_id, path in folder_paths(new_folders, root_node_id).items()}
+
+    changed_dirs = set()
+    for path, mtime, _ in new_kb_tree.iter_files():
+        old_mtime = old_kb_tree.get_mtime(path)
+        if old_mtime is None or (old_mtime != mtime and not (math.isnan(old_mtime) and math.isnan(mtime))):
+            changed_dirs.add(path.rpartition('/')[0])
+    for path, _, _ in old_kb_tree.iter_files():
+        if path not in new_kb_tree:
+            changed_dirs.add(path.rpartition('/')[0])
+
+    consistent = contradicting = 0
+    for path in changed_dirs:
+        if path not in old_times or path not in new_times:
+            # 文件夹本身是新建、删除、移动或改名的，无法用于判断
+            continue
+        if old_times[path] != new_times[path]:
+            consistent += 1
+        else:
+            print(f"  文件夹 '{path or '/'}' 中的文件有变化，但文件夹的修改时间未变化。")
+            contradicting += 1
+    return consistent, contradicting
+
+def find_dirty_folders(folders: dict, fresh_folders: dict) -> set:
+    """
+    对比缓存的文件夹元数据和最新元数据，找出需要重新列出子节点的文件夹。
+
+    - 文件夹已不存在（删除、移走或无权限）或不再是文件夹时，其父文件夹需要重新列出。
+    - 文件夹自身的修改时间或 hasChildren 发生变化时，该文件夹需要重新列出。
+
+    未变化的文件夹中的文件沿用上一次的 kb_tree.json，这依赖于文件变化会更新父文件夹的修改时间，
+    只有在 collect_folder_time_evidence 多次确认且从未发现反例后才会使用校验模式（见 can_verify_kb_tree）。
+
+    Returns:
+        set: 需要重新列出的文件夹ID集合。
+    """
+    dirty_folders = set()
+    for folder_id, cached in folders.items():
+        fresh = fresh_folders.get(folder_id)
+        if fresh is None or fresh.type != "FOLDER":
+            dirty_folders.add(cached[FOLDER_PARENT])
+        elif (fresh.modified_time != cached[FOLDER_MTIME]
+              or fresh.has_children != cached[FOLDER_HAS_CHILDREN]):
+            dirty_folders.add(folder_id)
+    dirty_folders.discard(None)
+    return dirty_folders
+
+def list_changed_folders(dirty_folders: set, folders: dict, access_token: str, operator_id: str):
     """
-    nodes = get_node_list(node_id, access_token, operator_id)
-    if nodes:
+    重新列出有变化的文件夹。若列出的子文件夹在缓存中属于另一个文件夹（被移动过来），
+    原文件夹也会被重新列出，避免同一个文件夹同时出现在新旧两个位置。
+
+    Returns:
+        dict: 文件夹ID到最新子节点列表的映射；任意一次列出失败时返回 None。
+    """
+    listings = {}
+    pending = list(dirty_folders)
+    while pending:
+        folder_id = pending.pop()
+        if folder_id in listings:
+            continue
+        nodes = get_node_list(folder_id, access_token, operator_id, none_on_error=True)
+        if nodes is None:
+            return None
+        listings[folder_id] = nodes
         for node in nodes:
-            # 替换路径中可能存在的无效字符
-            safe_node_name = node.name.replace('/', '_').replace('\\', '_')
-            current_path = f"{parent_path}/{safe_node_name}" if parent_path else safe_node_name
-            print(f"  正在处理知识库节点: {current_path} (类型: {node.type})")
-            
+            cached = folders.get(node.node_id)
+            if cached and cached[FOLDER_PARENT] != folder_id and cached[FOLDER_PARENT] not in listings:
+                pending.append(cached[FOLDER_PARENT])
+    return listings
+
+def rebuild_kb_nodes(node_id: str, access_token: str, operator_id: str, parent_path: str, file_tree,
+                     folder_cache: dict, folders: dict, children_index: dict, old_paths: dict,
+                     old_kb_tree, fresh_folders: dict, listings: dict):
+    """
+    使用缓存的目录结构、最新的文件夹元数据和上一次的 kb_tree.json 重建文件树。
+
+    有变化的文件夹使用重新列出的子节点；未变化的文件夹中，子文件夹使用最新元数据（名称可能改变），
+    文件从上一次的 kb_tree.json 中该文件夹原路径下读取。
+
+    Args:
+        node_id (str): 当前要重建的文件夹ID。
+        access_token (str): API访问令牌。
+        operator_id (str): 操作人的unionId。
+        parent_path (str): 当前文件夹的新路径。
+        file_tree (CompactTree): 用于存储文件树的紧凑文件树。
+        folder_cache (dict): 新的文件夹缓存，重建过程中写入。
+        folders (dict): 旧缓存中的文件夹元数据。
+        children_index (dict): 旧缓存中文件夹ID到子文件夹ID列表的映射。
+        old_paths (dict): 旧缓存中文件夹ID到其在上一次 kb_tree.json 中路径的映射。
+        old_kb_tree (CompactTree): 上一次写入的 kb_tree.json。
+        fresh_folders (dict): 批量接口返回的文件夹ID到最新节点对象的映射。
+        listings (dict): list_changed_folders 返回的有变化文件夹的最新子节点列表。
+
+    Returns:
+        bool: 新文件夹是否都成功完整遍历。
+    """
+    complete = True
+    if node_id in listings:
+        child_folders = []
+        for node in listings[node_id]:
+            current_path = kb_child_path(parent_path, node.name)
             if node.type == "FOLDER":
-                traverse_kb_nodes(node.node_id, access_token, operator_id, current_path, file_tree)
+                child_folders.append((node.node_id, node, current_path))
             elif node.type == "FILE":
-                # --- 新增：处理文件后缀名 ---
-                name, ext = os.path.splitext(current_path)
-                if ext in EXTENSION_MAPPING:
-                    new_ext = EXTENSION_MAPPING[ext]
-                    final_path = name + new_ext
-                    print(f"    后缀名转换: '{ext}' -> '{new_ext}'")
-                else:
-                    final_path = current_path
-                # --- 结束 ---
-
-                file_tree[final_path] = {
-                    "modifiedTime": node.modified_time,
-                    "url": node.url
-                }
+                add_kb_file(file_tree, current_path, node.modified_time, node.url)
+    else:
+        child_folders = [(child_id, fresh_folders[child_id], kb_child_path(parent_path, fresh_folders[child_id].name))
+                         for child_id in children_index.get(node_id, [])]
+        for name, mtime, url in old_kb_tree.iter_dir_files(old_paths[node_id]):
+            current_path = f"{parent_path}/{name}" if parent_path else name
+            try:
+                file_tree.add(current_path, mtime, url)
+            except ValueError as e:
+                print(f"警告: {e}，已跳过该条目。")
+
+    for child_id, node, current_path in child_folders:
+        folder_cache[child_id] = folder_cache_entry(node_id, node)
+        if child_id in folders and child_id in old_paths:
+            child_complete = rebuild_kb_nodes(child_id, access_token, operator_id, current_path, file_tree,
+                                              folder_cache, folders, children_index, old_paths,
+                                              old_kb_tree, fresh_folders, listings)
+        else:
+            # 缓存中没有的新文件夹，只能完整遍历
+            print(f"  发现新文件夹，完整遍历: {current_path}")
+            child_complete = traverse_kb_nodes(child_id, access_token, operator_id, current_path, file_tree,
+                                               folder_cache)
+        complete = complete and child_complete
+    return complete
+
+def load_node_cache(node_cache_file: str, root_node_id: str):
+    """
+    读取文件夹元数据缓存，缓存不存在、损坏或属于其他知识库时返回 None。
+    """
+    if not node_cache_file or not os.path.exists(node_cache_file):
+        return None
+    try:
+        with open(node_cache_file, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+    except (IOError, json.JSONDecodeError) as e:
+        print(f"警告: 无法读取节点缓存 '{node_cache_file}': {e}。将完整遍历知识库。")
+        return None
+    if cache.get("rootNodeId") != root_node_id or root_node_id not in cache.get("folders", {}):
+        print(f"节点缓存 '{node_cache_file}' 属于其他知识库或不完整，将完整遍历知识库。")
+        return None
+    return cache
+
+def load_previous_kb_tree(kb_tree_file: str, cache: dict):
+    """
+    读取与节点缓存同一次运行写入的 kb_tree.json，用于提供未变化文件夹中的文件。
+    文件不存在、已被其他程序修改（修改时间与缓存记录的不一致）或无法解析时返回 None。
+    """
+    try:
+        if os.path.getmtime(kb_tree_file) != cache.get("kbTreeMtime"):
+            print(f"'{kb_tree_file}' 与节点缓存不是同一次运行生成的，将完整遍历知识库。")
+            return None
+        with open(kb_tree_file, "r", encoding="utf-8") as f:
+            return CompactTree.load_json(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"警告: 无法读取上一次的知识库文件树 '{kb_tree_file}': {e}。将完整遍历知识库。")
+        return None
+
+def can_verify_kb_tree(cache: dict) -> bool:
+    """
+    判断本次能否使用校验模式。
+
+    只有当完整遍历已经在至少 FOLDER_TIME_CONFIRMATIONS 次运行中观察到文件变化同时更新了父文件夹的
+    修改时间，且从未观察到反例时，才使用校验模式；否则完整遍历并继续收集证据。
+    此外每连续校验 FULL_RESCAN_INTERVAL 次会完整遍历一次，以便持续检验这一假设。
+    """
+    evidence = cache.get("folderTimeEvidence", {})
+    if evidence.get("contradictions", 0):
+        print(f"此前观察到 {evidence['contradictions']} 次文件变化没有更新父文件夹的修改时间，"
+              f"校验模式不可靠，将完整遍历知识库。")
+        return False
+    if evidence.get("confirmedRuns", 0) < FOLDER_TIME_CONFIRMATIONS:
+        print(f"文件夹修改时间的更新规则尚未得到足够确认（{evidence.get('confirmedRuns', 0)}/"
+              f"{FOLDER_TIME_CONFIRMATIONS}），本次完整遍历知识库并继续检验。")
+        return False
+    if cache.get("runsSinceFullScan", 0) >= FULL_RESCAN_INTERVAL:
+        print(f"已连续校验 {FULL_RESCAN_INTERVAL} 次，本次完整遍历知识库以重新检验文件夹修改时间的更新规则。")
+        return False
+    return True
+
+def verify_cached_kb_tree(root_node_id: str, folders: dict, old_kb_tree, access_token: str, operator_id: str):
+    """
+    校验模式：只用批量获取节点接口检查缓存中的文件夹，仅对有变化的文件夹回退到 list_nodes。
+
+    知识库没有变化时只需要 ceil(文件夹数 / GET_NODES_BATCH_SIZE) 次请求，而完整遍历需要对每个文件夹
+    至少调用一次 list_nodes。例如 2000 个文件夹、每个文件夹 50 个文件时，约 67 次对比约 2000 次。
+
+    Args:
+        root_node_id (str): 知识库根节点ID。
+        folders (dict): 节点缓存中的文件夹元数据。
+        old_kb_tree (CompactTree): 上一次写入的 kb_tree.json。
+        access_token (str): API访问令牌。
+        operator_id (str): 操作人的unionId。
+
+    Returns:
+        tuple: (kb_tree, folder_cache)；需要完整遍历时（API请求失败、根节点不可用）返回 (None, None)。
+    """
+    folder_ids = list(folders)
+    print(f"校验模式: 批量获取 {len(folder_ids)} 个缓存文件夹的最新元数据...")
+    fresh_folders = get_nodes_metadata(folder_ids, access_token, operator_id)
+    if fresh_folders is None or root_node_id not in fresh_folders:
+        print("警告: 无法获取文件夹的最新元数据，将完整遍历知识库。")
+        return None, None
+    batches = -(-len(folder_ids) // GET_NODES_BATCH_SIZE)
+
+    dirty_folders = find_dirty_folders(folders, fresh_folders)
+    listings = list_changed_folders(dirty_folders, folders, access_token, operator_id)
+    if listings is None:
+        print("警告: 重新列出有变化的文件夹失败，将完整遍历知识库。")
+        return None, None
+
+    children_index = {}
+    for folder_id, cached in folders.items():
+        children_index.setdefault(cached[FOLDER_PARENT], []).append(folder_id)
+    old_paths = folder_paths(folders, root_node_id)
+
+    kb_tree = CompactTree()
+    folder_cache = {root_node_id: folder_cache_entry(None, fresh_folders[root_node_id])}
+    if not rebuild_kb_nodes(root_node_id, access_token, operator_id, "", kb_tree, folder_cache, folders,
+                            children_index, old_paths, old_kb_tree, fresh_folders, listings):
+        print("警告: 遍历新文件夹失败，将完整遍历知识库。")
+        return None, None
+    if listings:
+        print(f"校验完成: {batches} 次批量请求，重新列出了 {len(listings)} 个有变化的文件夹。")
+    else:
+        print(f"校验完成: {batches} 次批量请求，知识库结构没有变化。")
+    return kb_tree, folder_cache
+
+def save_node_cache(node_cache_file: str, root_node_id: str, folder_cache: dict, runs_since_full_scan: int,
+                    evidence: dict, kb_tree_mtime: float):
+    """
+    写入文件夹元数据缓存。根节点本身也记录在缓存中（父节点为 None），用于判断根目录下是否有新增节点。
+
+    - runsSinceFullScan: 自上次完整遍历以来的校验次数，用于定期强制完整遍历。
+    - folderTimeEvidence: collect_folder_time_evidence 累计的检验结果，决定是否可以使用校验模式。
+    - kbTreeMtime: 同一次运行写入的 kb_tree.json 的修改时间，校验模式只会沿用与缓存匹配的 kb_tree.json。
+    """
+    cache = {
+        "rootNodeId": root_node_id,
+        "runsSinceFullScan": runs_since_full_scan,
+        "folderTimeEvidence": evidence,
+        "kbTreeMtime": kb_tree_mtime,
+        "folders": folder_cache
+    }
+    try:
+        with open(node_cache_file, "w", encoding="utf-8") as f:
+            json.dump(cache, f, ensure_ascii=False)
+        print(f"节点元数据缓存已成功写入到 '{node_cache_file}'")
+    except IOError as e:
+        print(f"错误: 无法写入节点缓存 '{node_cache_file}': {e}")
 
 def get_nas_file_tree(nas_root_path):
     """
     生成NAS文件夹的文件树结构.
     """
     print(f"\n正在扫描本地NAS文件夹: {nas_root_path}")
-    file_tree = {}
+    file_tree = CompactTree(root_path=nas_root_path, with_urls=False)
     if not os.path.isdir(nas_root_path):
         print(f"警告: 本地NAS路径 '{nas_root_path}' 不存在或不是一个目录。将视为空文件夹。" )
         return file_tree
@@ -212,14 +581,9 @@ def get_nas_file_tree(nas_root_path):
             # 将Windows路径分隔符'\'统一替换为'/'
             relative_path = relative_path.replace('\\', '/')
             
-            modified_time = os.path.getmtime(file_path)
-            # 将时间戳转换为UTC时间的ISO 8601格式字符串，并附加'Z'
-            modified_time_iso = datetime.datetime.utcfromtimestamp(modified_time).isoformat(timespec='seconds') + 'Z'
-            
-            file_tree[relative_path] = {
-                "modifiedTime": modified_time_iso,
-                "path": file_path
-            }
+            # 直接保存精确到秒的时间戳，与知识库的修改时间精度一致
+            modified_time = math.floor(os.path.getmtime(file_path))
+            file_tree.add(relative_path, modified_time)
     print("本地NAS文件夹扫描完成。" )
     return file_tree
 
@@ -230,44 +594,38 @@ def compare_trees_and_get_urls(kb_tree, nas_tree):
     print("\n正在比较知识库与本地NAS文件...")
     urls_to_download = []
 
-    for kb_path, kb_info in kb_tree.items():
+    for kb_path, kb_time, url in kb_tree.iter_files():
+        nas_time = nas_tree.get_mtime(kb_path)
         # 检查文件是否在NAS中不存在
-        if kb_path not in nas_tree:
+        if nas_time is None:
             print(f"[新增] 文件 '{kb_path}' 在本地不存在，准备下载。" )
-            urls_to_download.append(kb_info['url'])
-        else:
-            # 文件已存在，比较修改时间
-            try:
-                # 解析不含毫秒和'Z'的ISO 8601时间字符串
-                nas_time_str = nas_tree[kb_path]['modifiedTime'].split('.')[0].replace('Z', '')
-                kb_time_str = kb_info['modifiedTime'].split('.')[0].replace('Z', '')
-                
-                nas_time = datetime.datetime.fromisoformat(nas_time_str)
-                kb_time = datetime.datetime.fromisoformat(kb_time_str)
-
-                if kb_time > nas_time:
-                    print(f"[更新] 文件 '{kb_path}' 在知识库中已更新，准备下载。 (知识库: {kb_time} > 本地: {nas_time})")
-                    urls_to_download.append(kb_info['url'])
-            except (ValueError, KeyError) as e:
-                print(f"警告: 处理文件 '{kb_path}' 的时间戳时出错: {e}。将默认下载该文件。" )
-                urls_to_download.append(kb_info['url'])
+            urls_to_download.append(url)
+        elif math.isnan(kb_time) or math.isnan(nas_time):
+            # 修改时间在构建文件树时已解析为时间戳，无法解析的记为NaN
+            print(f"警告: 处理文件 '{kb_path}' 的时间戳时出错: 无法解析修改时间。将默认下载该文件。" )
+            urls_to_download.append(url)
+        elif kb_time > nas_time:
+            print(f"[更新] 文件 '{kb_path}' 在知识库中已更新，准备下载。 "
+                  f"(知识库: {format_iso_time(kb_time)} > 本地: {format_iso_time(nas_time)})")
+            urls_to_download.append(url)
 
     print("文件比较完成。" )
     return urls_to_download
 
 
-def getdata(name, output, workspace_list, kb_tree_file, nas_path):
-    global WORKSPACE_NAME, OUTPUT_FILE, WORKSPACE_LIST_OUTPUT_FILE, KB_TREE_OUTPUT_FILE, NAS_ROOT_PATH
+def getdata(name, output, workspace_list, kb_tree_file, nas_path, node_cache_file=""):
+    global WORKSPACE_NAME, OUTPUT_FILE, WORKSPACE_LIST_OUTPUT_FILE, KB_TREE_OUTPUT_FILE, NAS_ROOT_PATH, KB_NODE_CACHE_FILE
     WORKSPACE_NAME = name
     OUTPUT_FILE = output
     WORKSPACE_LIST_OUTPUT_FILE = workspace_list
     KB_TREE_OUTPUT_FILE = kb_tree_file
     NAS_ROOT_PATH = nas_path
+    KB_NODE_CACHE_FILE = node_cache_file
 
 
-def main(name, output, workspace_list, kb_tree_file, nas_path, token):
+def main(name, output, workspace_list, kb_tree_file, nas_path, token, node_cache_file=""):
     # 初始化参数
-    getdata(name, output, workspace_list, kb_tree_file, nas_path)
+    getdata(name, output, workspace_list, kb_tree_file, nas_path, node_cache_file)
     global ACCESS_TOKEN
     ACCESS_TOKEN = token
 
@@ -275,19 +633,63 @@ def main(name, output, workspace_list, kb_tree_file, nas_path, token):
     root_node_id, _ = get_workspace_data(WORKSPACE_NAME, ACCESS_TOKEN, OPERATOR_ID)
 
     if root_node_id:
-        # 2. 获取知识库文件树
-        print(f"\n开始遍历知识库: '{WORKSPACE_NAME}' (根节点ID: {root_node_id})")
-        kb_tree = {}
-        traverse_kb_nodes(root_node_id, ACCESS_TOKEN, OPERATOR_ID, "", kb_tree)
-        print("知识库遍历完成。" )
+        # 2. 获取知识库文件树：校验模式的前提已被确认时先用批量接口校验，否则完整遍历
+        kb_tree = folder_cache = None
+        runs_since_full_scan = 0
+        cache = load_node_cache(KB_NODE_CACHE_FILE, root_node_id)
+        # 检验结果属于知识库本身，即使本次无法使用缓存也继续累计
+        evidence = dict(cache.get("folderTimeEvidence", {})) if cache else {}
+        evidence.setdefault("confirmedRuns", 0)
+        evidence.setdefault("contradictions", 0)
+        old_kb_tree = load_previous_kb_tree(KB_TREE_OUTPUT_FILE, cache) if cache else None
+        if old_kb_tree is not None and can_verify_kb_tree(cache):
+            print(f"\n开始校验知识库: '{WORKSPACE_NAME}' (根节点ID: {root_node_id})")
+            kb_tree, folder_cache = verify_cached_kb_tree(root_node_id, cache["folders"], old_kb_tree,
+                                                          ACCESS_TOKEN, OPERATOR_ID)
+            runs_since_full_scan = cache.get("runsSinceFullScan", 0) + 1
+        if kb_tree is None:
+            runs_since_full_scan = 0
+            print(f"\n开始遍历知识库: '{WORKSPACE_NAME}' (根节点ID: {root_node_id})")
+            kb_tree = CompactTree()
+            folder_cache = None
+            if KB_NODE_CACHE_FILE:
+                # 在遍历前记录根节点的元数据，遍历期间发生的变化会在下次校验时被发现
+                folder_cache = {}
+                root_node = (get_nodes_metadata([root_node_id], ACCESS_TOKEN, OPERATOR_ID) or {}).get(root_node_id)
+                if root_node:
+                    folder_cache[root_node_id] = folder_cache_entry(None, root_node)
+            if not traverse_kb_nodes(root_node_id, ACCESS_TOKEN, OPERATOR_ID, "", kb_tree, folder_cache):
+                # 不完整的文件树会让 compare_move_file.py 删除NAS中缺失子树的文件，因此直接中止
+                print("错误: 部分文件夹列出失败，知识库文件树不完整。"
+                      f"本次不写入 '{KB_TREE_OUTPUT_FILE}' 和URL列表，请稍后重试。")
+                return False
+            print("知识库遍历完成。" )
+
+            if old_kb_tree is not None and folder_cache and root_node_id in folder_cache:
+                consistent, contradicting = collect_folder_time_evidence(old_kb_tree, kb_tree, cache["folders"],
+                                                                         folder_cache, root_node_id)
+                if contradicting:
+                    evidence["contradictions"] += contradicting
+                    print(f"警告: {contradicting} 个文件夹中的文件有变化但文件夹修改时间未变化，校验模式将不再使用。")
+                elif consistent:
+                    evidence["confirmedRuns"] += 1
+                    print(f"本次遍历确认了文件变化会更新父文件夹的修改时间"
+                          f"（{evidence['confirmedRuns']}/{FOLDER_TIME_CONFIRMATIONS}）。")
+        old_kb_tree = None
 
         # 3. 将完整的知识库文件树写入JSON文件，供compare_move_file.py使用
         try:
             with open(KB_TREE_OUTPUT_FILE, "w", encoding="utf-8") as f:
-                json.dump(kb_tree, f, ensure_ascii=False, indent=4)
+                kb_tree.dump_json(f)
             print(f"完整的知识库文件树已成功写入到 '{KB_TREE_OUTPUT_FILE}'")
         except IOError as e:
             print(f"错误: 无法写入知识库文件树 '{KB_TREE_OUTPUT_FILE}': {e}")
+            folder_cache = None
+
+        # 缓存与本次写入的 kb_tree.json 配套保存，下次校验时从中读取未变化文件夹中的文件
+        if folder_cache and root_node_id in folder_cache:
+            save_node_cache(KB_NODE_CACHE_FILE, root_node_id, folder_cache, runs_since_full_scan,
+                            evidence, os.path.getmtime(KB_TREE_OUTPUT_FILE))
 
 
         # 4. 获取NAS文件树
@@ -310,8 +712,10 @@ def main(name, output, workspace_list, kb_tree_file, nas_path, token):
             print("\n--- 所有文件都是最新的，无需下载。 ---")
 
         print("\n任务完成！" )
+        return True
     else:
         print(f"错误: 无法找到名为 '{WORKSPACE_NAME}' 的知识库。请检查名称是否正确。" )
+        return False
 
 if __name__ == "__main__":
     # 这是一个示例，实际使用时请通过外部调用并传入参数
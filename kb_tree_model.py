@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+
+"""
+紧凑的文件树模型，供 get_KB_FILE_URL.py 和 compare_move_file.py 共用。
+
+原先的文件树是 {完整路径: {"modifiedTime": ..., "url": ...}} 形式的普通字典，
+每个完整路径都重复保存了所有祖先目录的名称，百万级节点时会占用数GB内存。
+
+CompactTree 的存储方式:
+- 路径被拆分为各级名称，目录名经过 sys.intern 驻留，相同名称只保存一份。
+- 每个节点是使用 __slots__ 的 _Node 对象，只保存自身名称和父节点指针，完整路径按需拼接。
+- 修改时间以UTC时间戳的形式保存在 array('d') 中，URL按文件序号保存在列表中。
+
+对外保持与原字典相同的查找方式: `path in tree`、`tree[path]`、`tree[path] = {...}`、
+`tree.items()`、`len(tree)`，并额外提供 get_mtime / has_dir 等不需要构造字典的快速接口。
+
+注意: 修改时间统一保存为精确到秒的UTC时间戳，写回 kb_tree.json 时格式化为
+'YYYY-MM-DDTHH:MM:SSZ'，无法解析的时间写为 null。
+"""
+import os
+import sys
+import json
+import math
+import calendar
+import datetime
+from array import array
+
+# 无法解析的修改时间用 NaN 表示
+INVALID_TIME = float('nan')
+# 流式读取 kb_tree.json 时每次读取的字符数
+JSON_CHUNK_SIZE = 64 * 1024
+
+
+def parse_iso_time(time_str) -> float:
+    """
+    将钉钉/本地生成的ISO 8601时间字符串解析为UTC时间戳（精确到秒）。
+
+    与原比较逻辑一致：去掉毫秒部分和结尾的'Z'。无法解析时返回 NaN。
+    """
+    try:
+        time_str = time_str.split('.')[0].replace('Z', '')
+        parsed = datetime.datetime.fromisoformat(time_str)
+    except (AttributeError, TypeError, ValueError):
+        return INVALID_TIME
+    return float(calendar.timegm(parsed.utctimetuple()))
+
+
+def format_iso_time(timestamp: float) -> str:
+    """将UTC时间戳格式化为 'YYYY-MM-DDTHH:MM:SSZ'，NaN 返回空字符串。"""
+    if math.isnan(timestamp):
+        return ""
+    return datetime.datetime.utcfromtimestamp(timestamp).isoformat(timespec='seconds') + 'Z'
+
+
+class _Node:
+    """
+    文件树中的一个节点。目录的 children 为 {名称: _Node} 字典，文件的 children 为 None；
+    文件的 index 指向 CompactTree 中修改时间数组和URL列表的位置，目录的 index 为 -1。
+    """
+    __slots__ = ('name', 'parent', 'children', 'index')
+
+    def __init__(self, name, parent, children, index):
+        self.name = name
+        self.parent = parent
+        self.children = children
+        self.index = index
+
+
+class CompactTree:
+    """
+    以驻留名称和父指针节点保存的文件树，只记录文件，目录由文件路径隐式产生。
+
+    :param root_path: 可选的本地根目录。设置后，tree[path] 返回的信息中会包含文件的完整本地路径 "path"。
+    :param with_urls: 是否保存URL。为 True 时 tree[path] 总是包含 "url" 键（没有URL时为 None），
+                      与原 kb_tree.json 的结构一致；NAS文件树不需要URL，可设为 False 以节省内存。
+    """
+    __slots__ = ('root_path', '_root', '_files', '_mtimes', '_urls')
+
+    def __init__(self, root_path=None, with_urls=True):
+        self.root_path = root_path
+        self._root = _Node('', None, {}, -1)
+        self._files = []            # 按序号保存的文件节点
+        self._mtimes = array('d')   # 按序号保存的修改时间（UTC时间戳）
+        self._urls = [] if with_urls else None  # 按序号保存的URL
+
+    @staticmethod
+    def _split(path):
+        """将路径规范化并拆分为各级名称，兼容 '/' 和当前系统的分隔符。"""
+        if os.sep != '/':
+            path = path.replace(os.sep, '/')
+        names = path.split('/')
+        # 绝大多数路径已是规范形式，只有包含空段、'.' 或 '..' 时才调用较慢的 normpath
+        if '' in names or '.' in names or '..' in names:
+            path = os.path.normpath(path).replace(os.sep, '/')
+            if path == '.':
+                return []
+            names = path.split('/')
+        return names
+
+    def _find(self, path):
+        """查找路径对应的节点，不存在时返回 None。"""
+        node = self._root
+        for name in self._split(path):
+            if node.children is None:
+                return None
+            node = node.children.get(name)
+            if node is None:
+                return None
+        return node
+
+    def _path_of(self, node):
+        """沿父指针拼接出节点的完整路径（使用 '/' 分隔）。"""
+        names = []
+        while node.parent is not None:
+            names.append(node.name)
+            node = node.parent
+        return '/'.join(reversed(names))
+
+    def add(self, path, mtime, url=None):
+        """
+        添加或更新一个文件。
+
+        :param path: 文件的相对路径。
+        :param mtime: 修改时间，UTC时间戳（float）。
+        :param url: 文件的URL，可选。
+        """
+        names = self._split(path)
+        if not names:
+            raise ValueError(f"无效的文件路径: '{path}'")
+        node = self._root
+        for name in names[:-1]:
+            child = node.children.get(name)
+            if child is None:
+                child = _Node(sys.intern(name), node, {}, -1)
+                node.children[child.name] = child
+            elif child.children is None:
+                raise ValueError(f"路径 '{path}' 与已有文件 '{self._path_of(child)}' 冲突")
+            node = child
+
+        name = names[-1]
+        existing = node.children.get(name)
+        if existing is not None:
+            if existing.children is not None:
+                raise ValueError(f"路径 '{path}' 与已有目录冲突")
+            self._mtimes[existing.index] = mtime
+            if self._urls is not None:
+                self._urls[existing.index] = url
+            return
+
+        index = len(self._files)
+        # 文件名几乎不会重复，驻留只会增加驻留表的开销，因此只驻留目录名
+        leaf = _Node(name, node, None, index)
+        node.children[leaf.name] = leaf
+        self._files.append(leaf)
+        self._mtimes.append(mtime)
+        if self._urls is not None:
+            self._urls.append(url)
+
+    def try_add(self, path, info) -> bool:
+        """
+        与 tree[path] = info 相同，但文件与目录路径冲突时打印警告并跳过，而不是抛出异常。
+
+        例如知识库中同时存在文件夹 '报告.docx' 和会被映射为 '报告.docx' 的文档 '报告.adoc'。
+        原先的字典实现会静默覆盖，这里至少保证整个遍历不会因为一个冲突而中断。
+
+        :return: 是否成功添加。
+        """
+        try:
+            self[path] = info
+        except ValueError as e:
+            print(f"警告: {e}，已跳过该条目。")
+            return False
+        return True
+
+    def get_mtime(self, path):
+        """返回文件的修改时间戳；文件不存在时返回 None。"""
+        node = self._find(path)
+        if node is None or node.children is not None:
+            return None
+        return self._mtimes[node.index]
+
+    def has_dir(self, path):
+        """判断路径是否为树中某个文件的上级目录。"""
+        node = self._find(path)
+        return node is not None and node.children is not None and node is not self._root
+
+    def iter_files(self):
+        """按添加顺序遍历所有文件，返回 (路径, 修改时间戳, URL)，不构造信息字典。"""
+        urls = self._urls if self._urls is not None else [None] * len(self._files)
+        for node, mtime, url in zip(self._files, self._mtimes, urls):
+            yield self._path_of(node), mtime, url
+
+    def iter_dir_files(self, path):
+        """遍历目录下直接包含的文件，返回 (文件名, 修改时间戳, URL)；path 为空字符串时表示根目录。"""
+        node = self._find(path)
+        if node is None or node.children is None:
+            return
+        for child in node.children.values():
+            if child.children is None:
+                url = self._urls[child.index] if self._urls is not None else None
+                yield child.name, self._mtimes[child.index], url
+
+    def _info(self, node):
+        mtime = self._mtimes[node.index]
+        info = {"modifiedTime": None if math.isnan(mtime) else format_iso_time(mtime)}
+        if self._urls is not None:
+            info["url"] = self._urls[node.index]
+        if self.root_path is not None:
+            info["path"] = os.path.join(self.root_path, *self._path_of(node).split('/'))
+        return info
+
+    # --- 与原字典相同的访问方式 ---
+
+    def __setitem__(self, path, info):
+        self.add(path, parse_iso_time(info.get("modifiedTime")), info.get("url"))
+
+    def __getitem__(self, path):
+        node = self._find(path)
+        if node is None or node.children is not None:
+            raise KeyError(path)
+        return self._info(node)
+
+    def get(self, path, default=None):
+        try:
+            return self[path]
+        except KeyError:
+            return default
+
+    def __contains__(self, path):
+        node = self._find(path)
+        return node is not None and node.children is None
+
+    def __len__(self):
+        return len(self._files)
+
+    def __iter__(self):
+        for node in self._files:
+            yield self._path_of(node)
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        for node in self._files:
+            yield self._path_of(node), self._info(node)
+
+    # --- 与 kb_tree.json 的相互转换 ---
+
+    @classmethod
+    def from_dict(cls, file_tree, root_path=None):
+        """从 {路径: {"modifiedTime": ..., "url": ...}} 形式的字典构建，路径冲突的条目会被跳过。"""
+        tree = cls(root_path)
+        for path, info in file_tree.items():
+            tree.try_add(path, info)
+        return tree
+
+    @classmethod
+    def load_json(cls, f, root_path=None):
+        """
+        流式读取 kb_tree.json，逐条加入文件树，不会像 json.load 那样先在内存中构造完整的字典。
+
+        格式错误（包括值不是对象、结尾有多余内容）时与 json.load 一样抛出 json.JSONDecodeError。
+        """
+        tree = cls(root_path)
+        decoder = json.JSONDecoder()
+        buffer = ""
+        position = 0
+        eof = False
+
+        def fill():
+            # 丢弃已解析的部分并读入下一块，返回是否读到了新数据
+            nonlocal buffer, position, eof
+            if eof:
+                return False
+            chunk = f.read(JSON_CHUNK_SIZE)
+            if not chunk:
+                eof = True
+                return False
+            buffer = buffer[position:] + chunk
+            position = 0
+            return True
+
+        def next_char():
+            # 跳过空白并返回下一个非空白字符（不消费），文件结束时返回空字符串
+            nonlocal position
+            while True:
+                while position < len(buffer) and buffer[position] in " \t\r\n":
+                    position += 1
+                if position < len(buffer):
+                    return buffer[position]
+                if not fill():
+                    return ""
+
+        def expect(chars):
+            nonlocal position
+            char = next_char()
+            if not char or char not in chars:
+                raise json.JSONDecodeError(f"期望 {' 或 '.join(repr(c) for c in chars)}", buffer, position)
+            position += 1
+            return char
+
+        def value():
+            # 读取一个完整的JSON值，数据不完整时继续读入
+            nonlocal position
+            next_char()
+            while True:
+                try:
+                    result, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if fill():
+                        continue
+                    raise
+                # 数字等值可能恰好在块边界被截断，未到文件末尾时补读后重新解析
+                if end == len(buffer) and fill():
+                    continue
+                position = end
+                return result
+
+        def finish():
+            # 与 json.load 一致，结尾的 '}' 之后只允许空白
+            if next_char():
+                raise json.JSONDecodeError("结尾存在多余的数据", buffer, position)
+            return tree
+
+        expect("{")
+        if next_char() == "}":
+            position += 1
+            return finish()
+        while True:
+            path = value()
+            if not isinstance(path, str):
+                raise json.JSONDecodeError("键必须是字符串", buffer, position)
+            expect(":")
+            info = value()
+            if not isinstance(info, dict):
+                raise json.JSONDecodeError(f"路径 '{path}' 的值必须是对象", buffer, position)
+            tree.try_add(path, info)
+            if expect(",}") == "}":
+                return finish()
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def dump_json(self, f):
+        """
+        以与 json.dump(..., ensure_ascii=False, indent=4) 相同的格式逐条写出，
+        避免为了序列化而临时构造完整的字典。
+        """
+        f.write("{")
+        first = True
+        for path, info in self.items():
+            f.write("\n" if first else ",\n")
+            first = False
+            body = json.dumps(info, ensure_ascii=False, indent=4).replace("\n", "\n    ")
+            f.write(f"    {json.dumps(path, ensure_ascii=False)}: {body}")
+        f.write("\n}" if not first else "}")